@@ -1,9 +1,22 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import fitz  # PyMuPDF
+import numpy as np
 import re
+import io
 from datetime import datetime
+from enum import IntEnum
+
+# ----------------------------
+# CONSTANTS
+# ----------------------------
+ALL_TESTS = ("HbA1c", "Glucose", "Hb", "Platelet", "WBC", "ESR",
+             "ALT", "AST", "Calcium", "PSA", "Weight", "Date",
+             "TSH", "T3", "T4", "Neutrophils", "Lymphocytes", "Monocytes")
+DEFAULT_TESTS = ("HbA1c", "Glucose", "Hb", "Platelet", "WBC", "ESR",
+                 "ALT", "AST", "Calcium", "PSA", "Weight", "Date")
+NUMERIC_COLS = tuple(test for test in ALL_TESTS if test != "Date")
+MANUAL_TESTS = ("HbA1c", "Glucose", "Hb", "Platelet", "WBC", "ESR", "ALT", "AST", "Calcium", "Weight")
+NUMBER_RE = re.compile(r"\s*(?:\d+(?:\.\d*)?|\.\d+)\s*")
 
 # ----------------------------
 # PAGE CONFIG
@@ -17,31 +30,32 @@ Create your **Digital Twin**, upload lab reports, add manual data, analyze trend
 # ----------------------------
 # 1️⃣ Digital Twin Profile
 # ----------------------------
-st.header("1️⃣ Create Your Digital Twin")
-col1, col2, col3 = st.columns(3)
-age = col1.number_input("Age", 0, 120, 45)
-gender = col2.selectbox("Gender", ["Male", "Female", "Other"])
-height = col3.number_input("Height (cm)", 50, 250, 170)
+@st.fragment
+def digital_twin_profile():
+    # Profile inputs only feed the BMI, so editing them reruns just this section
+    st.header("1️⃣ Create Your Digital Twin")
+    col1, col2, col3 = st.columns(3)
+    age = col1.number_input("Age", 0, 120, 45)
+    gender = col2.selectbox("Gender", ["Male", "Female", "Other"])
+    height = col3.number_input("Height (cm)", 50, 250, 170)
+
+    col4, col5, col6 = st.columns(3)
+    weight = col4.number_input("Weight (kg)", 10, 200, 70)
+    location = col5.text_input("Location", "Mumbai")
+    activity = col6.selectbox("Activity Level", ["Low", "Moderate", "High"])
 
-col4, col5, col6 = st.columns(3)
-weight = col4.number_input("Weight (kg)", 10, 200, 70)
-location = col5.text_input("Location", "Mumbai")
-activity = col6.selectbox("Activity Level", ["Low", "Moderate", "High"])
+    bmi = round(weight / ((height / 100) ** 2), 2)
+    st.metric("Your BMI", bmi)
 
-bmi = round(weight / ((height / 100) ** 2), 2)
-st.metric("Your BMI", bmi)
+digital_twin_profile()
 
 # ----------------------------
 # 2️⃣ Lab Test Selection
 # ----------------------------
-all_tests = ["HbA1c", "Glucose", "Hb", "Platelet", "WBC", "ESR",
-             "ALT", "AST", "Calcium", "PSA", "Weight", "Date",
-             "TSH", "T3", "T4", "Neutrophils", "Lymphocytes", "Monocytes"]
-
 selected_tests = st.multiselect(
     "Select lab tests to extract from PDF",
-    all_tests,
-    default=["HbA1c","Glucose","Hb","Platelet","WBC","ESR","ALT","AST","Calcium","PSA","Weight","Date"]
+    ALL_TESTS,
+    default=DEFAULT_TESTS
 )
 
 # ----------------------------
@@ -56,95 +70,250 @@ uploaded_files = st.file_uploader(
 # ----------------------------
 # PDF TEXT EXTRACTION FUNCTION
 # ----------------------------
-def extract_text_from_pdf(file):
-    doc = fitz.open(file)
-    text = ""
-    for page in doc:
-        text += page.get_text()
-    return text
+@st.cache_data(show_spinner=False)
+def extract_text_from_pdf(file_bytes):
+    import fitz  # PyMuPDF, imported on first upload rather than at startup
+    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+        # Newline between pages so a value at the end of one page can't merge
+        # with digits at the top of the next into one number
+        return "\n".join(page.get_text("text") for page in doc)
 
 # ----------------------------
 # DYNAMIC LAB VALUE EXTRACTION
 # ----------------------------
+TEST_NAMES = {test.lower(): test for test in ALL_TESTS}
+VALUE_CLEAN = str.maketrans("", "", ",")
+# Indian lab reports print dates day first, e.g. "12.03.2023"
+REPORT_DATE_FORMATS = ("%d.%m.%Y", "%d.%m.%y")
+# One alternation over every test name, longest first so "HbA1c" is tried before "Hb".
+# Names match ASCII-only so case folding can't accept letters like "ı" that
+# TEST_NAMES has no lowercase key for.
+TEST_RE = re.compile(
+    r"(?a:(?P<name>" + "|".join(map(re.escape, sorted(ALL_TESTS, key=len, reverse=True))) + r"))[:\s]*(?P<value>[\d.,]+)",
+    re.IGNORECASE
+)
+
+def parse_report_date(value):
+    # strptime avoids pandas' per-call parser setup; only the known formats are tried
+    for fmt in REPORT_DATE_FORMATS:
+        try:
+            return pd.Timestamp(datetime.strptime(value, fmt))
+        except ValueError:
+            continue
+    return pd.NaT
+
+@st.cache_data(show_spinner=False)
 def extract_lab_values_dynamic(text, tests):
+    wanted = set(tests)
+    if not wanted:
+        return {}
     lab_data = {}
-    for test in tests:
-        pattern = rf"{test}[:\s]*([\d.,]+)"
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            value = match.group(1).replace(",", "")
-            try:
-                lab_data[test] = float(value)
-            except:
-                lab_data[test] = value
+    for match in TEST_RE.finditer(text):
+        test = TEST_NAMES[match.group("name").lower()]
+        if test in wanted and test not in lab_data:
+            value = match.group("value")
+            if test == "Date":
+                lab_data[test] = parse_report_date(value)
+            else:
+                # Kept as text; numeric columns are converted together when the frame is built
+                lab_data[test] = value.translate(VALUE_CLEAN)
+            if len(lab_data) == len(wanted):
+                break
     return lab_data
 
 # ----------------------------
-# 4️⃣ Initialize DataFrame
+# RISK SCORING
+# ----------------------------
+RISK_COLS = ("HbA1c", "Glucose", "Hb", "Platelet", "WBC", "Monocytes", "ALT", "AST", "Calcium")
+I_HBA1C, I_GLUCOSE = RISK_COLS.index("HbA1c"), RISK_COLS.index("Glucose")
+
+def indicator_layout(indicators):
+    # indicators: (tests, direction) pairs. An indicator counts once when any of
+    # its tests moves in that direction (+1 rise, -1 fall).
+    direction = np.zeros(len(RISK_COLS))
+    groups = np.zeros((len(indicators), len(RISK_COLS)), dtype=np.int8)
+    for row, (tests, sign) in enumerate(indicators):
+        for test in tests:
+            direction[RISK_COLS.index(test)] = sign
+            groups[row, RISK_COLS.index(test)] = 1
+    return direction, groups
+
+PANCREATIC_DIR, PANCREATIC_GROUPS = indicator_layout([
+    (("HbA1c",), +1), (("Platelet",), +1), (("ALT", "AST"), +1),
+    (("WBC", "Monocytes"), +1), (("Calcium",), +1), (("Hb",), -1),
+])
+COLORECTAL_DIR, COLORECTAL_GROUPS = indicator_layout([
+    (("Hb",), -1), (("Platelet",), +1), (("WBC",), +1), (("Calcium",), +1),
+])
+
+class Risk(IntEnum):
+    LOW = 0
+    MODERATE = 1
+    HIGH = 2
+
+RISK_LABELS = {Risk.LOW: "🟢 Low", Risk.MODERATE: "🟠 Moderate", Risk.HIGH: "🔴 High"}
+
+def get_risk_level(score):
+    if score >= 5: return Risk.HIGH
+    elif score >= 3: return Risk.MODERATE
+    else: return Risk.LOW
+
+def diabetes_levels(hba1c, glucose):
+    # Classifies every entry at once; a missing value compares False
+    return np.select(
+        [(hba1c > 6.5) | (glucose > 130), hba1c > 5.7],
+        [Risk.HIGH, Risk.MODERATE],
+        default=Risk.LOW
+    )
+
+def score_changes(values):
+    # values: one float32 row per entry in date order, laid out like RISK_COLS.
+    # Scores every consecutive pair of entries at once.
+    signs = np.sign(np.diff(values, axis=0))
+    pancreatic = ((signs == PANCREATIC_DIR) @ PANCREATIC_GROUPS.T > 0).sum(axis=1)
+    colorectal = ((signs == COLORECTAL_DIR) @ COLORECTAL_GROUPS.T > 0).sum(axis=1)
+    return pancreatic, colorectal
+
+@st.cache_data(show_spinner=False)
+def compute_risks(recent, has_diabetes_tests):
+    # recent: last one or two entries as float32 rows laid out like RISK_COLS,
+    # missing tests are NaN so every comparison on them is False
+    diabetes_risk = None
+    if has_diabetes_tests:
+        diabetes_risk = Risk(int(diabetes_levels(recent[:, I_HBA1C], recent[:, I_GLUCOSE])[-1]))
+
+    pancreatic_risk_score = 0
+    colorectal_risk_score = 0
+    if len(recent) >= 2:
+        pancreatic_scores, colorectal_scores = score_changes(recent)
+        pancreatic_risk_score = int(pancreatic_scores[-1])
+        colorectal_risk_score = int(colorectal_scores[-1])
+
+    return diabetes_risk, get_risk_level(pancreatic_risk_score), get_risk_level(colorectal_risk_score)
+
+# ----------------------------
+# TREND FIGURE
 # ----------------------------
-df_all = pd.DataFrame()
+@st.cache_data(show_spinner=False)
+def make_trend_figure(trend_df, x_col, trend_cols):
+    # Plotly is only needed once there is data to chart
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
+    # One figure with a WebGL subplot per test. Columns go in as NumPy arrays
+    # so Plotly sends them as typed-array buffers instead of JSON number lists.
+    n_rows = -(-len(trend_cols) // 3)
+    fig = make_subplots(rows=n_rows, cols=3, subplot_titles=trend_cols)
+    # Missing readings are masked once for all tests so each line joins the
+    # entries that actually report that test.
+    x = trend_df[x_col].to_numpy()
+    values = trend_df[list(trend_cols)].to_numpy(dtype=np.float32)
+    present = ~np.isnan(values)
+    for i, col in enumerate(trend_cols):
+        rows = present[:, i]
+        fig.add_trace(
+            go.Scattergl(x=x[rows], y=values[rows, i], mode="lines+markers", name=col),
+            row=i // 3 + 1,
+            col=i % 3 + 1
+        )
+    fig.update_layout(height=300 * n_rows, showlegend=False)
+    return fig
+
+# ----------------------------
+# EXCEL EXPORT
+# ----------------------------
+@st.cache_data(show_spinner=False)
+def to_excel_bytes(df):
+    buffer = io.BytesIO()
+    # %.7g writes float32 values back out at the precision they were entered with
+    df.to_excel(buffer, index=False, engine="openpyxl", float_format="%.7g")
+    return buffer.getvalue()
+
+# ----------------------------
+# 4️⃣ Collect Lab Rows
+# ----------------------------
+# Rows are kept as plain dicts and turned into a DataFrame once, below
+if "manual_rows" not in st.session_state:
+    st.session_state.manual_rows = []
 
 # Process PDFs
+pdf_rows = []
 if uploaded_files:
+    test_key = tuple(sorted(selected_tests))
     for file in uploaded_files:
-        text = extract_text_from_pdf(file)
-        data = extract_lab_values_dynamic(text, selected_tests)
-        df_all = pd.concat([df_all, pd.DataFrame([data])], ignore_index=True)
+        try:
+            text = extract_text_from_pdf(file.getvalue())
+        except Exception as e:
+            st.error(f"Could not read {file.name}: {e}")
+            continue
+        pdf_rows.append(extract_lab_values_dynamic(text, test_key))
 
 # ----------------------------
 # 5️⃣ Manual Data Entry
 # ----------------------------
 st.header("📋 Manual Lab Data Entry (Optional)")
 with st.form("manual_entry_form"):
-    col1, col2, col3 = st.columns(3)
-    manual_date = col1.date_input("Date", datetime.today())
-    manual_hba1c = col2.text_input("HbA1c", "")
-    manual_glucose = col3.text_input("Glucose", "")
-
-    col4, col5, col6 = st.columns(3)
-    manual_hb = col4.text_input("Hb", "")
-    manual_platelet = col5.text_input("Platelet", "")
-    manual_wbc = col6.text_input("WBC", "")
-
-    col7, col8, col9 = st.columns(3)
-    manual_esr = col7.text_input("ESR", "")
-    manual_alt = col8.text_input("ALT", "")
-    manual_ast = col9.text_input("AST", "")
-
-    col10, col11 = st.columns(2)
-    manual_calcium = col10.text_input("Calcium", "")
-    manual_weight = col11.text_input("Weight", "")
+    # Date followed by one text box per test, three to a row
+    cols = st.columns(3)
+    manual_date = cols[0].date_input("Date", datetime.today())
+    manual_values = {}
+    for i, test in enumerate(MANUAL_TESTS, start=1):
+        if i % 3 == 0:
+            cols = st.columns(min(3, len(MANUAL_TESTS) + 1 - i))
+        manual_values[test] = cols[i % 3].text_input(test, "")
 
     submit_button = st.form_submit_button("Add Manual Entry")
 
-# Append manual data to df_all
-manual_data = {}
+# Manual entries are kept for the session so they can be compared with each other
 if submit_button:
-    manual_data["Date"] = pd.to_datetime(manual_date)
-    if manual_hba1c: manual_data["HbA1c"] = float(manual_hba1c)
-    if manual_glucose: manual_data["Glucose"] = float(manual_glucose)
-    if manual_hb: manual_data["Hb"] = float(manual_hb)
-    if manual_platelet: manual_data["Platelet"] = float(manual_platelet)
-    if manual_wbc: manual_data["WBC"] = float(manual_wbc)
-    if manual_esr: manual_data["ESR"] = float(manual_esr)
-    if manual_alt: manual_data["ALT"] = float(manual_alt)
-    if manual_ast: manual_data["AST"] = float(manual_ast)
-    if manual_calcium: manual_data["Calcium"] = float(manual_calcium)
-    if manual_weight: manual_data["Weight"] = float(manual_weight)
-
-    if df_all.empty:
-        df_all = pd.DataFrame([manual_data])
+    manual_data = {"Date": pd.Timestamp(manual_date)}
+    invalid = []
+    for test, raw in manual_values.items():
+        if not raw:
+            continue
+        if NUMBER_RE.fullmatch(raw):
+            manual_data[test] = float(raw)
+        else:
+            invalid.append(f"{test} ('{raw}')")
+
+    # Only whole entries are saved; the form keeps its values for correction
+    if invalid:
+        st.warning(f"Entry not added, not a number: {', '.join(invalid)}")
+    elif len(manual_data) == 1:
+        st.warning("Entry not added: enter at least one lab value")
     else:
-        df_all = pd.concat([df_all, pd.DataFrame([manual_data])], ignore_index=True)
+        st.session_state.manual_rows.append(manual_data)
+        st.success("Manual entry added successfully!")
+
+if st.session_state.manual_rows:
+    st.caption(f"Manual entries saved this session: {len(st.session_state.manual_rows)}")
+    cols = st.columns(2)
+    cols[0].button("Undo Last Manual Entry", on_click=st.session_state.manual_rows.pop)
+    cols[1].button("Clear Manual Entries", on_click=st.session_state.manual_rows.clear)
 
-    if "Date" in df_all.columns:
-        df_all = df_all.sort_values("Date")
-    st.success("Manual entry added successfully!")
+# Build the merged DataFrame once, columns in the fixed test order
+lab_rows = pdf_rows + st.session_state.manual_rows
+found_tests = set().union(*lab_rows)
+df_all = pd.DataFrame(lab_rows, columns=[test for test in ALL_TESTS if test in found_tests])
+# PDF values arrive as text; convert each numeric column in one pass.
+# float32 holds integers up to 2**24 exactly and about 7 significant digits,
+# which covers counts like Platelet 2,50,000 as well as decimal results.
+numeric_cols = [col for col in NUMERIC_COLS if col in df_all.columns]
+for col in numeric_cols:
+    df_all[col] = pd.to_numeric(df_all[col], errors="coerce").astype(np.float32)
+# PDF and manual dates are both parsed to Timestamps (or NaT) before this point
+if "Date" in df_all.columns:
+    df_all["Date"] = pd.to_datetime(df_all["Date"]).astype("datetime64[s]")
+    # Entries are usually added in date order already, so only sort when needed
+    if not df_all["Date"].is_monotonic_increasing:
+        df_all = df_all.sort_values("Date", kind="stable", ignore_index=True)
 
 # ----------------------------
 # 6️⃣ Display Data
 # ----------------------------
-if not df_all.empty:
+@st.fragment
+def show_analysis(df_all, numeric_cols):
+    # Widget interactions in here rerun only this section, not the ingestion above
     st.subheader("Merged Lab Data")
     st.dataframe(df_all)
 
@@ -152,97 +321,53 @@ if not df_all.empty:
     # Trend Visualization
     # ----------------------------
     st.subheader("Trend Visualization")
-    numeric_cols = df_all.select_dtypes(include='number').columns
-    for col in numeric_cols:
-        fig = px.line(
-            df_all, 
-            x="Date" if "Date" in df_all.columns else df_all.index,
-            y=col, 
-            title=f"{col} Trend", 
-            markers=True
-        )
-        st.plotly_chart(fig, use_container_width=True)
+    x_col = "Date" if "Date" in df_all.columns else "Entry"
+    trend_df = df_all if x_col == "Date" else df_all.rename_axis("Entry").reset_index()
+    if numeric_cols:
+        fig = make_trend_figure(trend_df, x_col, tuple(numeric_cols))
+        st.plotly_chart(fig, use_container_width=True, theme=None)
 
     # Increase/Decrease Alerts
     if len(df_all) >= 2:
-        last = df_all.iloc[-1]
-        prev = df_all.iloc[-2]
         st.subheader("Increase/Decrease Alerts (Last Entry vs Previous)")
-        alerts = {}
-        for col in numeric_cols:
-            delta = last[col] - prev[col]
-            if delta > 0:
-                alerts[col] = f"⬆ Increased by {delta}"
-            elif delta < 0:
-                alerts[col] = f"⬇ Decreased by {abs(delta)}"
-            else:
-                alerts[col] = "No change"
+        values = df_all[numeric_cols].tail(2).to_numpy()
+        deltas = values[-1] - values[-2]
+        alerts = {
+            col: f"⬆ Increased by {delta:g}" if delta > 0
+            else f"⬇ Decreased by {-delta:g}" if delta < 0
+            else "No change"
+            for col, delta in zip(numeric_cols, deltas.tolist())
+        }
         st.write(alerts)
 
     # ----------------------------
-    # Diabetes Risk Scoring
+    # Risk Scoring (cached on the last two entries)
     # ----------------------------
+    recent = df_all[numeric_cols].reindex(columns=RISK_COLS).tail(2).to_numpy(dtype=np.float32)
+    diabetes_risk, pancreatic_risk, colorectal_risk = compute_risks(
+        recent,
+        "HbA1c" in numeric_cols and "Glucose" in numeric_cols
+    )
+
     st.subheader("Diabetes Risk Assessment")
-    diabetes_risk = "Unknown"
-    if "HbA1c" in df_all.columns and "Glucose" in df_all.columns:
-        last_hba1c = df_all["HbA1c"].iloc[-1]
-        last_glucose = df_all["Glucose"].iloc[-1]
-        if last_hba1c > 6.5 or last_glucose > 130:
-            diabetes_risk = "🔴 High"
-        elif last_hba1c > 5.7:
-            diabetes_risk = "🟠 Moderate"
-        else:
-            diabetes_risk = "🟢 Low"
-    st.metric("Diabetes Risk", diabetes_risk)
+    st.metric("Diabetes Risk", RISK_LABELS.get(diabetes_risk, "Unknown"))
 
-    # ----------------------------
-    # Cancer Risk Scoring
-    # ----------------------------
     st.subheader("Cancer Risk Assessment")
-    pancreatic_risk_score = 0
-    colorectal_risk_score = 0
-    if len(df_all) >= 2:
-        last = df_all.iloc[-1]
-        prev = df_all.iloc[-2]
-        change = last - prev
-
-        # Pancreatic Cancer Indicators
-        if "HbA1c" in change.index and change["HbA1c"] > 0: pancreatic_risk_score += 1
-        if "Platelet" in change.index and change["Platelet"] > 0: pancreatic_risk_score += 1
-        if ("ALT" in change.index and change["ALT"] > 0) or ("AST" in change.index and change["AST"] > 0): pancreatic_risk_score += 1
-        if ("WBC" in change.index and change["WBC"] > 0) or ("Monocytes" in change.index and "Monocytes" in df_all.columns and change["Monocytes"] > 0): pancreatic_risk_score += 1
-        if "Calcium" in change.index and change["Calcium"] > 0: pancreatic_risk_score += 1
-        if "Hb" in change.index and change["Hb"] < 0: pancreatic_risk_score += 1
-
-        # Colorectal Cancer Indicators
-        if "Hb" in change.index and change["Hb"] < 0: colorectal_risk_score += 1
-        if "Platelet" in change.index and change["Platelet"] > 0: colorectal_risk_score += 1
-        if "WBC" in change.index and change["WBC"] > 0: colorectal_risk_score += 1
-        if "Calcium" in change.index and change["Calcium"] > 0: colorectal_risk_score += 1
-
-    def get_risk_label(score):
-        if score >= 5: return "🔴 High"
-        elif score >= 3: return "🟠 Moderate"
-        else: return "🟢 Low"
-
-    pancreatic_risk = get_risk_label(pancreatic_risk_score)
-    colorectal_risk = get_risk_label(colorectal_risk_score)
-
-    st.metric("Pancreatic Cancer Risk", pancreatic_risk)
-    st.metric("Colorectal Cancer Risk", colorectal_risk)
+    st.metric("Pancreatic Cancer Risk", RISK_LABELS[pancreatic_risk])
+    st.metric("Colorectal Cancer Risk", RISK_LABELS[colorectal_risk])
 
     # ----------------------------
     # Excel Download
     # ----------------------------
     st.subheader("📥 Download Data")
-    df_to_download = df_all.copy()
-    df_to_download["Date"] = df_to_download["Date"].astype(str)
     st.download_button(
         label="Download as Excel",
-        data=df_to_download.to_excel(index=False, engine='openpyxl'),
+        data=to_excel_bytes(df_all),
         file_name="digital_twin_lab_data.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
 
+if not df_all.empty:
+    show_analysis(df_all, numeric_cols)
 else:
     st.info("Upload PDF lab reports or add manual entries to analyze trends.")